@@ -23,8 +23,8 @@
 #   clear_line
 #   open_port
 #   ctrlc
-#   reduce
 #   eval_packet
+#   compute_cksum
 #   add_cksum
 #   write_max
 #   request_reg_states
@@ -41,8 +41,9 @@ import serial
 from datetime import datetime, timezone
 import signal
 import sys
-import numpy as np
 import csv
+from functools import lru_cache, reduce
+from operator import xor
 
 SOCKET_PATH = '/tmp/afe_service.sock'
 
@@ -55,6 +56,7 @@ rate = 60
 global last_write
 last_write = 0.0
 debounce = 1 # increase to 2 for desperate debugging
+rate_changed = threading.Event() # wakes tick() when block 5 sets a new rate
 
 
 #For debouncing
@@ -73,25 +75,25 @@ class Telemetry:
     
     def __init__(self):
         self.telem = []
-        self.registers = []
+        self.telem_fields = []              # CSV fields, parsed once on arrival
+        self.registers = bytearray()     # 7 registers x 10 bits, row * 10 + bit
         self.NMEAtime = 0
 
     def add_telem(self, data):
         self.telem.append(data)
+        self.telem_fields.append(data.split('*')[0].split(','))
 
     def add_registers(self, data):
-        self.registers = data
+        self.registers = bytearray(int(bit) for row in data for bit in row)
 
     def request_telem(self):
 
       self.telem.clear()
+      self.telem_fields.clear()
 
       uart.readall()
 
-      msg_draft = "$TELEM?*"
-      msg = add_cksum(msg_draft)
-
-      write_uart(msg.encode())
+      write_uart(TELEM_QUERY)
 
       msg_end = False
 
@@ -126,7 +128,27 @@ class Telemetry:
 
       request_reg_states()
 
-      return np.stack(self.telem, self.registers)
+      all_items = [line.strip() for line in self.telem]
+
+      for row in range(7):
+
+        if row == 0:
+          tag = "MAINREG:"
+
+        elif row in (1, 2):
+          idx = str(row)
+          tag = "TX" + idx + "REG: "
+
+        elif row in (3, 4, 5, 6):
+          idx = str(row - 2)
+          tag = "RX" + idx + "REG: "
+
+        if len(self.registers) == 70:
+          all_items.append(tag + str(list(self.registers[row * 10:row * 10 + 10])))
+        else:
+          all_items.append(tag + "n/a")
+
+      return all_items
     
     def log(self):
         
@@ -157,13 +179,7 @@ class Telemetry:
 
         with open(full_path, "w", newline="", encoding="utf-8") as telem_csv:
           writer = csv.writer(telem_csv)
-          for i in range(len(self.telem)):
-            try:
-              line = self.telem[i].split('*')[0]
-              line = line.split(',')
-              writer.writerow(line)
-            except IndexError as e:
-              print("Index Error on: ", line)
+          writer.writerows(self.telem_fields)
             
 #          writer.writerow(<tuner>) # ADD TUNER TELEM HERE
 
@@ -180,15 +196,16 @@ class Telemetry:
               idx = str(row - 2)
               line = ["RX" + idx + "REG"]
 
-            for column in range(10):
-              state = self.registers[row][column]
-              line.append(state)
+            if len(self.registers) == 70:
+              line.extend(self.registers[row * 10:row * 10 + 10])
+            else:                          # no register reply yet
+              line.extend(["n/a"] * 10)
             
             writer.writerow(line) 
             line = []
         
-        print(self.registers)
-        print(np.stack(self.telem))
+        print(list(self.registers))
+        print("".join(self.telem))
         print("Telemetry logged at: ", filename) # /data/metadata
 
 global_telemetry = Telemetry()
@@ -202,21 +219,21 @@ def handle_commands(conn):
     conn.close()
     return
   
-  command = raw.decode('utf-8', errors='ignore').split()
+  command = list(map(int, raw.decode('utf-8', errors='ignore').split()))
 
-  block, channel, addr, bit = map(int, command)
+  block, channel, addr, bit = command[:4]
 
-  if block in (0, 1, 2):          # Instruction is to write a register
-    write_max(block, channel, addr, bit)
+  if block in (0, 1, 2):          # Instruction is to write registers
+    for i in range(0, len(command) - 3, 4):
+      write_max(*command[i:i + 4])
     global_telemetry.log()
     conn.sendall(b"AFE Controls Updated\n")
 
   elif block == 3:
 
-    array = global_telemetry.print()
-    msg = array.tobytes()
-    print(msg)                                #    NEED TO FIX
-    conn.sendall(b"Placeholder\n")
+    all_items = global_telemetry.print()
+    response = "All Telemetry:\n" + "\n".join(all_items) + "\n"
+    conn.sendall(response.encode('ascii'))
 
   elif block == 4:
     
@@ -225,7 +242,7 @@ def handle_commands(conn):
 
   elif block == 5:
     rate = channel
-    threading.Timer(rate-2, tick).start()
+    rate_changed.set()
     str_rate = str(channel)
     print(rate)
     conn.sendall(b"Telemetry log period updated")
@@ -268,16 +285,6 @@ def ctrlc(signal, frame):
 
         sys.exit(0)
 
-def reduce(iterable, initializer=None):
-    it = iter(iterable)
-    if initializer is None:
-        value = next(it)
-    else:
-        value = initializer
-    for element in it:
-        value = value ^ element
-    return value
-
 def eval_packet(packet,gen_cksm_f=False,debug_f=False):
      err_code = 0 
      ascii_checksum = 0 
@@ -288,28 +295,30 @@ def eval_packet(packet,gen_cksm_f=False,debug_f=False):
        print("packet:", packet)
      # endif debug
 
-     dollar_cnt = packet.count("$")
-     star_cnt = packet.count("*")
+     if isinstance(packet, str):      # serial reads are bytes, skip the round trip
+       packet = packet.encode('ascii', 'replace')   # noise becomes '?', fails below
+     # endif
 
-     if (packet[0] == '$'):
-       if (dollar_cnt != star_cnt):               # lost data
+     star_ix = packet.find(b"*")      # one scan finds the end of the data
+
+     if (packet[:1] == b'$'):
+       if (star_ix < 0) or (packet.find(b"$", 1, star_ix) >= 0):   # lost data
          if (verbose_f):
-           print("err: be", dollar_cnt, star_cnt)   # be = begin end
+           print("err: be", star_ix)   # be = begin end
          # endif extra info
          err_code = -1
        else:
          if (debug_f):
-           pass #print("number of sentences in data:",dollar_cnt,"len=",len(packet))
+           pass #print("sentence data len=",len(packet))
          # endif
      else:                                       # pre-checked, should not happen
-       print("data does not begin with '$'", dollar_cnt, star_cnt) 
+       print("data does not begin with '$'", star_ix) 
        err_code = -2
      # end else error
 
      if (err_code == 0):
-       packet = packet.strip("$\n")
-       
-       nmeadata, ascii_checksum = packet.split("*",1)
+       nmeadata = packet[1:star_ix]
+       ascii_checksum = packet[star_ix + 1:].rstrip(b"$\n").decode('ascii', 'replace')
        if (debug_f):
            print("nmeadata=", nmeadata)
        # endif
@@ -330,7 +339,7 @@ def eval_packet(packet,gen_cksm_f=False,debug_f=False):
      # endif not error
       
      if (err_code == 0):
-       calculated_checksum = reduce((ord(s) for s in nmeadata), 0)
+       calculated_checksum = compute_cksum(nmeadata)
        if (checksum == calculated_checksum):
          if (debug_f):
            print("success,checksum=",hex(checksum),                                   
@@ -359,26 +368,28 @@ def eval_packet(packet,gen_cksm_f=False,debug_f=False):
      # endif parse passes checks  
      return err_code, ascii_checksum, calculated_checksum
 
-def add_cksum(pkt_in):
+def compute_cksum(body):
 
-  packet_out = ""
+  return reduce(xor, body, 0)          # bytes iterate as ints
 
-  err_code, dck, cck = eval_packet(pkt_in,gen_cksm_f=True,debug_f=False)
-  if (err_code != 0):
-    err_f = True
-  # endif
+@lru_cache(maxsize=128)                # Same few commands every tick
+def add_cksum(pkt_in):
 
-  ck_hex = hex(cck)             # to string
-  ck_split = ck_hex.split('x')  # split at hex identifier
-  ck_str = ck_split[1].upper()  # upper case
-  if ( len(ck_str) == 1):       # if single digit
-    ck_str = "0" + ck_str       # then prefix with '0', ex: "0A"
-  # endif single digit
-    
-  packet_out = pkt_in + ck_str
+  # Generation only needs the XOR of the body; eval_packet's sentence
+  # checks are left to the receive path
+  core = pkt_in.split('*', 1)[0].lstrip('$')
+
+  packet_out = pkt_in + format(compute_cksum(core.encode('ascii')), "02X")   # two digit upper case hex, ex: "0A"
 
   return packet_out
 
+TELEM_QUERY = add_cksum("$TELEM?*").encode()
+REG_TAGS = ("MA", "XT1", "XT2", "XR1", "XR2", "XR3", "XR4")
+# Each query ends its own line so the firmware's readline() splits a pair
+REG_QUERIES = tuple(add_cksum(f"$PMIT{tag}?*").encode() + b"\r\n" for tag in REG_TAGS)
+REG_BITS = slice(14, 33, 2)            # '$PMITSR,0,<tag>,' is 14 chars for every tag
+REG_REPLY_ROWS = {"MA?": 0, "XT1": 1, "XT2": 2, "XR1": 3, "XR2": 4, "XR3": 5, "XR4": 6}
+
 def write_max(block, channel, addr, bit):
 
   msg_draft = "$PMIT"
@@ -400,7 +411,8 @@ def write_max(block, channel, addr, bit):
   msg_draft += "," + str(addr) + "," + str(bit) + "*"
   msg = add_cksum(msg_draft)
 
-  uart.write(msg.encode())
+  # Debounced so each write is its own readline() on the firmware side
+  write_uart(msg.encode())
 
   print("Writing to MAX: " + msg)
 
@@ -408,115 +420,55 @@ def write_max(block, channel, addr, bit):
 
 def request_reg_states():
 
-  main_reg = []
-  
-  tx1_reg = []
-  tx2_reg = []
-
-  rx1_reg = []
-  rx2_reg = []
-  rx3_reg = []
-  rx4_reg = []
+  reg_list = [None] * len(REG_QUERIES)
 
   uart.readall()
 
-  msg_draft = "$PMITMA?*"
-  msg = add_cksum(msg_draft)
-  write_uart(msg.encode())
-
-  line = None
+  # Two queries in flight at a time keeps both inside the RP2040's 64 byte
+  # UART buffer; replies are routed by the tag the firmware echoes back
+  for i in range(0, len(REG_QUERIES), 2):
 
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      main_reg.append(line[i])
+    pair = REG_QUERIES[i:i + 2]
 
-  line = None
-
-  msg_draft = "$PMITXT1?*"
-  msg = add_cksum(msg_draft)
-  uart.write(msg.encode())
-
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      tx1_reg.append(line[i])
-
-  line = None
-
-  msg_draft = "$PMITXT2?*"
-  msg = add_cksum(msg_draft)
-  uart.write(msg.encode())
-
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      tx2_reg.append(line[i])
-
-  line = None
-
-  msg_draft = "$PMITXR1?*"
-  msg = add_cksum(msg_draft)
-  uart.write(msg.encode())
-
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      rx1_reg.append(line[i])
-
-  line = None
-
-  msg_draft = "$PMITXR2?*"
-  msg = add_cksum(msg_draft)
-  uart.write(msg.encode())
-
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      rx2_reg.append(line[i])
-
-  line = None
-  msg_draft = "$PMITXR3?*"
-  msg = add_cksum(msg_draft)
-  uart.write(msg.encode())
-
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      rx3_reg.append(line[i])
-
-  line = None
-
-  msg_draft = "$PMITXR4?*"
-  msg = add_cksum(msg_draft)
-  uart.write(msg.encode())
-
-  while line is None:
-    line = uart.readline()
-    line = line.decode()
-    for i in range(14, 33, 2):
-      rx4_reg.append(line[i])
-
-  line = None
+    if i == 0:
+      write_uart(b"".join(pair))       # debounced against the last command
+    else:
+      uart.write(b"".join(pair))
+
+    for _ in pair:
+      line = uart.readline().decode('ascii', 'replace')
+      fields = line.split(',')         # $PMITSR,0,<tag>,<bits>...
+      if len(fields) >= 13 and fields[2] in REG_REPLY_ROWS:
+        bits = line[REG_BITS]
+        if len(bits) == 10 and bits.isdigit():   # garbled reply counts as missing
+          reg_list[REG_REPLY_ROWS[fields[2]]] = bits
+
+  if None in reg_list:
+    print("Missing register reply, keeping previous states")
+    return
 
-  reg_list = main_reg, tx1_reg, tx2_reg, rx1_reg, rx2_reg, rx3_reg, rx4_reg
-  global_telemetry.add_registers(np.stack(reg_list))
+  global_telemetry.add_registers(reg_list)
 
   return
 
 def tick():
 
-  global rate
+  # One loop on a monotonic deadline replaces the Timer chain, so there is
+  # no per-period thread and no rate offset to tune
+  deadline = time.monotonic() + rate
 
-  print("Periodic log:")
-  global_telemetry.log()
-  threading.Timer(rate-1, tick).start() #rate offset will need to vary as the script is updated, likely rate -1
+  while True:
+    if rate_changed.wait(max(0, deadline - time.monotonic())):
+      rate_changed.clear()             # New period starts from now
+      deadline = time.monotonic() + rate
+      continue
+
+    print("Periodic log:")
+    global_telemetry.log()
+
+    deadline += rate
+    if deadline < time.monotonic():    # Log overran a whole period
+      deadline = time.monotonic() + rate
 
 def main():
 
@@ -527,9 +479,7 @@ def main():
   print("Initial log:")
   global_telemetry.log()
 
-  threading.Timer(rate, tick).start()
-  
-  #while True:
+  tick()
 
 if __name__ == '__main__':
 
@@ -11,6 +11,7 @@
 #
 #   send_command
 #   print_help
+#   build_parser
 #   parse_command_line
 #   update_reg_states
 #   main
@@ -20,58 +21,69 @@
 import socket
 import sys
 import argparse
+from functools import lru_cache
 
 SOCKET_PATH = "/tmp/afe_service.sock"
+UDS_BUF_SIZE = 1 << 20
+BIT_ADDRS = ("0","1","2","3","4","5","6","7","8","9")   # register bit choices
+REG_FLAGS = (("main", 0, -1),                          # dest, block, channel
+             ("tx1", 1, 1), ("tx2", 1, 2),
+             ("rx1", 2, 1), ("rx2", 2, 2), ("rx3", 2, 3), ("rx4", 2, 4))
 
-def send_command(block, channel, addr, bit):
+def send_command(commands):
 
-    msg = f"{block} {channel} {addr} {bit}"
+    msg = " ".join(f"{block} {channel} {addr} {bit}"
+                   for block, channel, addr, bit in commands)
     command = msg.encode('utf-8')
     
     with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+      s.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDS_BUF_SIZE)
+      s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDS_BUF_SIZE)
       s.connect(SOCKET_PATH)
       s.sendall(command)
-      reply = s.recv(4096).decode('utf-8', errors='ignore').strip()
+      chunks = []
+      for chunk in iter(lambda: s.recv(65536), b''):  # service closes when done
+        chunks.append(chunk)
+      reply = b''.join(chunks).decode('utf-8', errors='ignore').strip()
       print(reply)
 
     return 
 
+HELP_TEXT = "".join((
+  "\nTools:\n\n",
+  ">> afe.py  [-h]  [-p]  [-l]  [-r <logging rate>] \n\n",
+  "  -h, --help         Show this help message and exit\n",
+  "  -p, --print        Print the current telemetry and register states\n",
+  "  -l, --log          Log the current telemetry and register states\n",
+  "  -r, --rate         Select period of telemetry logging (in seconds)",
+
+  "\nShortcuts:\n\n",
+  ">> afe.py  [-a <0/1>]  [-i <channel> <0,1>]\n\n",
+  "  -h, --help         Show this help message and exit\n",
+  "  -a, --antenna      GNSS Antenna Select <0/1> (Internal/External)\n",
+  "  -i, --inputrf      RF Input select <channel> (1,2,3,4) <0/1/> (Internal/External)\n",
+
+  "\nManual Reguster Programming:\n\n",
+  ">> afe.py  <block>  <addr>  <value>\n",
+  ">> afe.py  -rx2  9  1\n\n",
+  "  <block>\n",
+  "     -m, --main           Main register (trigs, ebias, pps sel, ref sel, antenna sel)\n",
+  "     -tx1, tx2            TX registers (blank sel, filter bypass)\n",
+  "     -rx1, rx2, rx2, rx4  RX registers (chan bias, rf trig, filter byp, amp byp, atten)\n\n",
+
+  "  <addr>\n",
+  "     Register address: 0-9\n\n",
+
+  "  <value>\n",
+  "     Register value to set: 0,1\n",
+))
+
 def print_help():
 
-  msg = "\nRUN ONLY ONE COMMAND AT A TIME\n\n"
+  print(HELP_TEXT)
 
-  msg = "\nTools:\n\n"
-  msg = msg + ">> afe.py  [-h]  [-p]  [-l]  [-r <logging rate>] \n\n"
-  msg = msg + "  -h, --help         Show this help message and exit\n"
-  msg = msg + "  -p, --print        Print the current telemetry and register states\n"
-  msg = msg + "  -l, --log          Log the current telemetry and register states\n"
-  msg = msg + "  -r, --rate         Select period of telemetry logging (in seconds)"
-  
-  msg = msg + "\nShortcuts:\n\n"
-  msg = msg + ">> afe.py  [-a <0/1>]  [-i <channel> <0,1>]\n\n"
-  msg = msg + "  -h, --help         Show this help message and exit\n"
-  msg = msg + "  -a, --antenna      GNSS Antenna Select <0/1> (Internal/External)\n"
-  msg = msg + "  -i, --inputrf      RF Input select <channel> (1,2,3,4) <0/1/> (Internal/External)\n"
-
-  msg = msg + "\nManual Reguster Programming:\n\n"
-  msg = msg + ">> afe.py  <block>  <addr>  <value>\n"
-  msg = msg + ">> afe.py  -rx2  9  1\n\n"
-  msg = msg + "  <block>\n"
-  msg = msg + "     -m, --main           Main register (trigs, ebias, pps sel, ref sel, antenna sel)\n"
-  msg = msg + "     -tx1, tx2            TX registers (blank sel, filter bypass)\n"
-  msg = msg + "     -rx1, rx2, rx2, rx4  RX registers (chan bias, rf trig, filter byp, amp byp, atten)\n\n"
-
-  msg = msg + "  <addr>\n"
-  msg = msg + "     Register address: 0-9\n\n"
-
-  msg = msg + "  <value>\n"
-  msg = msg + "     Register value to set: 0,1\n"
-  
-  print(msg)
-
-def parse_command_line():
-    
-    error_flag = False
+@lru_cache(maxsize=1)                  # Built on first parse, then reused
+def build_parser():
 
     parser = argparse.ArgumentParser(add_help=False)
 
@@ -83,17 +95,22 @@ def parse_command_line():
     parser.add_argument("-a", "--antenna", choices=["0","1"])
     parser.add_argument("-i", "--inputrf", nargs=2, choices=["0","1","2","3","4"]) 
 
-    parser.add_argument("-m", "--main", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
-    parser.add_argument("-tx1", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
-    parser.add_argument("-tx2", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
+    parser.add_argument("-m", "--main", nargs=2, choices=BIT_ADDRS)
+    parser.add_argument("-tx1", nargs=2, choices=BIT_ADDRS)
+    parser.add_argument("-tx2", nargs=2, choices=BIT_ADDRS)
+
+    parser.add_argument("-rx1", nargs=2, choices=BIT_ADDRS)
+    parser.add_argument("-rx2", nargs=2, choices=BIT_ADDRS)
+    parser.add_argument("-rx3", nargs=2, choices=BIT_ADDRS)
+    parser.add_argument("-rx4", nargs=2, choices=BIT_ADDRS)
 
-    parser.add_argument("-rx1", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
-    parser.add_argument("-rx2", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
-    parser.add_argument("-rx3", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
-    parser.add_argument("-rx4", nargs=2, choices=["0","1","2","3","4","5","6","7","8","9"])
+    return parser
 
+def parse_command_line(argv=None):
+    
+    error_flag = False
 
-    (args,unknowns) = parser.parse_known_args()
+    (args,unknowns) = build_parser().parse_known_args(argv)
 
     if args.help_flag:
       print_help()
@@ -115,6 +132,11 @@ def update_reg_states(args):
   #   3: print state
   #   4: log state
   #   5: change logging rate
+  #
+  # Register writes are collected and sent as one batch; print, log and
+  # rate are single commands
+
+  commands = []
 
   if args.print:
     block = 3
@@ -134,60 +156,17 @@ def update_reg_states(args):
     addr = -1
     value = -1
 
-  if args.main:
-    block = 0
-    channel = -1
-    addr_str, value_str = args.main
-    addr = int(addr_str)
-    value = int(value_str)
-
-  if args.tx1:
-    block = 1
-    channel = 1
-    addr_str, value_str = args.tx1
-    addr = int(addr_str)
-    value = int(value_str)
-  
-  if args.tx2:
-    block = 1
-    channel = 2
-    addr_str, value_str = args.tx2
-    addr = int(addr_str)
-    value = int(value_str)
-
-  if args.rx1:
-    block = 2
-    channel = 1
-    addr_str, value_str = args.rx1
-    addr = int(addr_str)
-    value = int(value_str)
-
-  if args.rx2:
-    block = 2
-    channel = 2
-    addr_str, value_str = args.rx2
-    addr = int(addr_str)
-    value = int(value_str)
-    
-  if args.rx2:
-    block = 2
-    channel = 3
-    addr_str, value_str = args.rx3
-    addr = int(addr_str)
-    value = int(value_str)
-
-  if args.rx2:
-    block = 2
-    channel = 4
-    addr_str, value_str = args.rx4
-    addr = int(addr_str)
-    value = int(value_str)
+  for dest, reg_block, reg_channel in REG_FLAGS:
+    pair = getattr(args, dest)
+    if pair:
+      commands.append((reg_block, reg_channel, int(pair[0]), int(pair[1])))
 
   if args.antenna:
     block = 0
     channel = -1
     addr = 9
     value = int(args.antenna)
+    commands.append((block, channel, addr, value))
   
   if args.inputrf:
     block = 2
@@ -195,22 +174,34 @@ def update_reg_states(args):
     channel_str, value_str = args.inputrf
     channel = int(channel_str)
     value = 1 - int(value_str)
+    commands.append((block, channel, addr, value))
+
+  if len(commands) == 0:
+    commands.append((block, channel, addr, value))
 
-  return block, channel, addr, value
+  return commands
 
 def main():
-   
-  error_flag, args = parse_command_line() # parse command line options
-   
-  if (error_flag):
-    sys.exit()
 
-  if (len(sys.argv) > 1):
-    block, channel, addr, value = update_reg_states(args)
-    send_command(block, channel, addr, value)
-  else:
+  argv = sys.argv[1:]
+
+  # Nothing to parse for a bare call or a help request
+  if (len(argv) == 0):
     print("No command given. List of commands:")
     print_help()
+    sys.exit()
+
+  if ("-h" in argv) or ("--help" in argv):
+    print_help()
+    sys.exit()
+
+  error_flag, args = parse_command_line(argv) # parse command line options
+
+  if (error_flag):
+    sys.exit()
+
+  commands = update_reg_states(args)
+  send_command(commands)
 
   sys.exit()
 
@@ -51,26 +51,35 @@
 #
 # --------------------------
 #
+# Class: ServiceState
+#
+#   __init__
+#
 # Class: Telemetry
 #
 #   __init__
-#   request_telem
-#   request_registers
+#   request_state
 #   print
 #   log
 #
 #
 # List of Functions:
 #
+#   frame_cmd
 #   send_nmea_command
 #   start_command_server
+#   command_worker
 #   handle_commands
+#   gpsd_lines
 #   gpsd_monitor
+#   telemetry_consumer
+#   csv_writer
 #   nmea_to_epoch
-#   reduce
-#   eval_packet
+#   format_timestamp
+#   eval_fast
 #   add_cksum
-#   write_max
+#   max_sentence
+#   write_max_batch
 #   init_all
 #   main
 #
@@ -88,112 +97,130 @@
 #
 # --------------------------
 
+import calendar
+import io
 import os
 import time
 import socket
+import queue
+import selectors
 import threading
-from datetime import datetime, timezone
-import numpy as np
 import csv
+from functools import lru_cache, reduce
+from operator import xor
 
 SOCKET_PATH = '/tmp/afe_service.sock'  # Path for comms with afe.py
+GPSD_CONTROL_PATH = '/var/run/gpsd.sock'  # gpsd control socket (-F)
+UDS_BUF_SIZE = 1 << 20                 # Telemetry replies go out in one send
+GPSD_RCVBUF = 1 << 20                  # Kernel buffer for the raw NMEA stream
+CMD_ACK_TIMEOUT = 2.0                  # Seconds to wait for a $PMITSR per register write
+
+gpsd_out_lock = threading.Lock()       # One gpsd control command at a time
+telem_q = queue.SimpleQueue()          # gpsd_monitor -> telemetry_consumer
+csv_q = queue.Queue(maxsize=32)        # Telemetry.log -> csv_writer
+cmd_q = queue.SimpleQueue()            # start_command_server -> command_worker
+rate_changed = threading.Event()       # Wakes main() when block 5 sets a new rate
+cmd_ack = threading.Event()            # Set by gpsd_lines on each $PMITSR reply
+day_epochs = {}                        # RMC date -> epoch at 00:00 UTC
+
+LINE_KINDS = {                         # Sentence tag -> telemetry_consumer kind
+  'PGPS': 'gps_start',
+  'PGPN': 'gps_end',
+  'PTEL': 'telem_start',
+  'PMIT': 'telem',
+  'PMAX': 'regs',
+}
+DIGIT_VALUES = bytes.maketrans(b'0123456789', bytes(range(10)))   # '0' -> 0
+KEPT_PREFIXES = tuple(b'$' + tag.encode('ascii') for tag in LINE_KINDS) + (b'$G',)
+
+class ServiceState:
+
+    # Settings shared by the command server, scheduler and monitor threads
+    __slots__ = ('device', 'rate', 'new_run', 'path', 'run_lock', 'gpsd')
 
-global device
-global rate
-global new_run
-global gpsd
-global gps_in_progress
-global telem_in_progress
-global regs_in_progress
+    def __init__(self):
+      self.device = '/dev/ttyGNSS1'    # Device name for RP2040
+      self.rate = 60                   # Defaults to 60s logging period
+      self.new_run = True              # Next log opens a new run folder
+      self.path = None                 # Run folder under /data/telemetry_log
+      self.run_lock = threading.Lock() # One log() opens the run folder
+      self.gpsd = None                 # gpsd raw NMEA connection
 
-device = '/dev/ttyGNSS1'               # Device name for RP2040
-rate = 60                              # Defaults to 60s logging period
-gps_in_progress = True                 # Flag to avoid printing an incomplete log
-telem_in_progress = True
-regs_in_progress = True
+state = ServiceState()
+
+@lru_cache(maxsize=64)
+def frame_cmd(cmd_str):
 
-def send_nmea_command(cmd_str):
-  
   if not cmd_str.endswith("\r\n"):
     cmd_str += "\r\n"
 
   hexcmd = cmd_str.encode("ascii").hex()
-  message = f"&{device}={hexcmd}\n"
-
-  gpsd_out = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-  gpsd_out.connect("/var/run/gpsd.sock")
+  return f"&{state.device}={hexcmd}\n".encode("ascii")
 
-  gpsd_out.sendall(message.encode("ascii"))
+def send_nmea_command(cmd_str):
   
-  reply = gpsd_out.recv(4096).decode("ascii").strip()
+  message = frame_cmd(cmd_str)
+
+  # gpsd stalls on an open control connection until the client closes it,
+  # so the socket can't be kept between commands; close it right away
+  with gpsd_out_lock:
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as gpsd_out:
+      gpsd_out.connect(GPSD_CONTROL_PATH)
+      gpsd_out.sendall(message)
+      reply = gpsd_out.recv(16)          # Always "OK\n" or "ERROR\n"
   
-  if reply != "OK":
-    raise RuntimeError(f"gpsd error on send. reply: {reply}")
-
-  gpsd_out.close
+  if reply[:2] != b"OK":
+    raise RuntimeError(f"gpsd error on send. reply: {reply!r}")
 
 class Telemetry:
 
+    __slots__ = ('gps', 'telem', 'registers', 'regs_filled', 'RTCtime',
+                 'gps_ready', 'telem_ready', 'regs_ready')
+
     def __init__(self):
 
       self.gps = []
       self.telem = []
-      self.registers = []
+      self.registers = bytearray(70)   # 7 registers x 10 bits, row * 10 + bit
+      self.regs_filled = 0             # Rows of self.registers from the last $PMAX
       self.RTCtime = None
 
-    def request_telem(self):
-
-      self.telem.clear()
+      self.gps_ready = threading.Event()    # Set by telemetry_consumer once
+      self.telem_ready = threading.Event()  # each group is complete
+      self.regs_ready = threading.Event()
 
-      msg_draft = "$TELEM?*"
-      msg = add_cksum(msg_draft)
-      send_nmea_command(msg)
+    def request_state(self):
 
-    def request_registers(self):
+      self.regs_filled = 0
 
-      self.registers.clear()
+      # Cleared before sending so a fast reply can't set them first
+      self.telem_ready.clear()
+      self.regs_ready.clear()
 
-      msg_draft = "$MAX?*"
-      msg = add_cksum(msg_draft)
-      send_nmea_command(msg)
+      # Both queries ride in one gpsd command (gpsd only acts on the first
+      # line of each control write, so they can't be sent as two frames)
+      send_nmea_command(STATE_QUERY)
 
     def print(self):
 
-      global gps_in_progress
-      global telem_in_progress
-      global regs_in_progress
-
-      self.request_telem()
-      self.request_registers()
-
-      telem_in_progress = True
-      regs_in_progress = True
+      self.request_state()
 
       all_items = []
 
-      start = time.monotonic()
-      wait = 0
-      while gps_in_progress is True and wait < 1.2:
-        wait = time.monotonic() - start
-        time.sleep(0.001)
+      # The consumer swaps in a new list per group, so take one reference
+      self.gps_ready.wait(1.2)
+      gps = self.gps
 
-      for i in range(len(self.gps)):
-        all_items.append(str(self.gps[i]))
+      for item in gps:
+        all_items.append(str(item))
 
-      start = time.monotonic()
-      wait = 0
-      while telem_in_progress is True and wait < 1.2:
-        wait = time.monotonic() - start
-        time.sleep(0.001)
+      self.telem_ready.wait(1.2)
+      telem = self.telem
 
-      for i in range(len(self.telem)):
-        all_items.append(str(self.telem[i]))
+      for item in telem:
+        all_items.append(str(item))
 
-      start = time.monotonic()
-      wait = 0
-      while regs_in_progress is True and wait < 1.2:
-            wait = time.monotonic() - start
-            time.sleep(0.001)
+      self.regs_ready.wait(1.2)
 
       for row in range(7):
           
@@ -208,107 +235,86 @@ class Telemetry:
           idx = str(row - 2)
           tag = "RX" + idx + "REG: "
 
-        all_items.append(tag + str(self.registers[i]))
+        if row < self.regs_filled:
+          all_items.append(tag + str(list(self.registers[row * 10:row * 10 + 10])))
+        else:
+          all_items.append(tag + "n/a")
       
       return all_items
 
     def log(self):
 
-        global new_run
-        global path
-        global gps_in_progress
-        global telem_in_progress
-        global regs_in_progress
-
-        self.request_telem()
-        self.request_registers() 
+        self.request_state()
 
-        telem_in_progress = True
-        regs_in_progress = True       
-
-        start = time.monotonic()
-        wait = 0
-        while gps_in_progress is True and wait < 1.2:
-          wait = time.monotonic() - start
-          time.sleep(0.001)
+        self.gps_ready.wait(1.2)
 
         if self.RTCtime is None:
-          self.RTCtime = int(datetime.now(timezone.utc).timestamp())
+          self.RTCtime = int(time.time())
         
-        t = datetime.fromtimestamp(self.RTCtime, tz=timezone.utc)
-        timestamp = t.strftime("%Y-%m-%d_%H:%M:%S")
+        timestamp = format_timestamp(self.RTCtime)
 
-        if new_run is True:
-          base = "/data/telemetry_log"
-          folder_name = f"mep-telemetry-log_{timestamp}"
-          path = os.path.join(base, folder_name)
-          os.makedirs(path, exist_ok=True)
-          new_run = False
+        with state.run_lock:
+          if state.new_run is True:
+            base = "/data/telemetry_log"
+            folder_name = f"mep-telemetry-log_{timestamp}"
+            state.path = os.path.join(base, folder_name)
+            os.makedirs(state.path, exist_ok=True)
+            state.new_run = False
 
         filename = f"telemetry_{timestamp}.csv"
-        full_path = os.path.join(path, filename)
-
-        with open(full_path, "w", newline="", encoding="utf-8") as telem_csv:
-          writer = csv.writer(telem_csv)
-
-          for i in range(len(self.gps)):
-            try:
-              line = self.gps[i].split('*')[0]
-              line = line.split(',')
-              writer.writerow(line)
-            except IndexError:
-              print("GPS Index Error on: ", line)
-            except AttributeError:
-              print("GPS Attribute Error on: ", line)
-
-          start = time.monotonic()
-          wait = 0
-          while telem_in_progress is True and wait < 0.4:
-            wait = time.monotonic() - start
-            time.sleep(0.001)
-
-          for i in range(len(self.telem)):
-            try:
-              line = self.telem[i].split('*')[0]
-              line = line.split(',')
-              writer.writerow(line)
-            except IndexError:
-              print("Telemetry Index Error on: ", line)
-            except AttributeError:
-              print("Telemetry Attribute Error on: ", line)
-
-#         writer.writerow(<tuner>) # ADD TUNER TELEM HERE
-
-          start = time.monotonic()
-          wait = 0
-          while regs_in_progress is True and wait < 0.4:
-            wait = time.monotonic() - start
-            time.sleep(0.001)
-
-          for row in range(7):
-
-            if row == 0:
-              line = ["MAINREG"]
-
-            elif row in (1, 2):
-              idx = str(row)
-              line = ["TX" + idx + "REG"]
-
-            elif row in (3, 4, 5, 6):
-              idx = str(row - 2)
-              line = ["RX" + idx + "REG"]
-
-            for column in range(10):
-              try:
-                state = self.registers[row][column]
-              except IndexError:
-                state = "n/a"
-              line.append(state)
-
-            writer.writerow(line)
-            line = []
-
-        print("Telemetry logged at: ", filename)
+        full_path = os.path.join(state.path, filename)
+
+        rows = []
+
+        # The consumer swaps in a new list per group, so take one reference
+        gps = self.gps
+
+        for item in gps:
+          try:
+            rows.append(item.split('*')[0].split(','))
+          except AttributeError:
+            print("GPS Attribute Error on: ", item)
+
+        self.telem_ready.wait(0.4)
+        telem = self.telem
+
+        for item in telem:
+          try:
+            rows.append(item.split('*')[0].split(','))
+          except AttributeError:
+            print("Telemetry Attribute Error on: ", item)
+
+#       rows.append(<tuner>) # ADD TUNER TELEM HERE
+
+        self.regs_ready.wait(0.4)
+
+        for row in range(7):
+
+          if row == 0:
+            line = ["MAINREG"]
+
+          elif row in (1, 2):
+            idx = str(row)
+            line = ["TX" + idx + "REG"]
+
+          elif row in (3, 4, 5, 6):
+            idx = str(row - 2)
+            line = ["RX" + idx + "REG"]
+
+          for column in range(10):
+            if row < self.regs_filled:
+              bit = self.registers[row * 10 + column]
+            else:
+              bit = "n/a"
+            line.append(bit)
+
+          rows.append(line)
+
+        # Disk I/O happens on csv_writer so the log period never waits on it
+        try:
+          csv_q.put_nowait((full_path, rows))
+        except queue.Full:
+          print("CSV queue full, telemetry dropped: ", filename)
 
 global_telemetry = Telemetry()
 
@@ -321,28 +327,69 @@ def start_command_server():
       raise
 
   server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDS_BUF_SIZE)
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDS_BUF_SIZE)
   server.bind(SOCKET_PATH)
-  server.listen(1)
+  server.listen(8)
+  server.setblocking(False)
+
+  sel = selectors.DefaultSelector()
+  sel.register(server, selectors.EVENT_READ)
+
+  threading.Thread(target=command_worker, daemon=True).start()
+
+  # One thread accepts and reads every client; commands then run in order
+  # on command_worker instead of on a new thread per connection
+  while True:
+    for key, _ in sel.select():
+
+      if key.fileobj is server:
+        try:
+          conn, _ = server.accept()
+        except BlockingIOError:
+          continue
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, UDS_BUF_SIZE)
+        conn.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDS_BUF_SIZE)
+        conn.setblocking(False)
+        sel.register(conn, selectors.EVENT_READ)
+        continue
+
+      conn = key.fileobj
+      sel.unregister(conn)
+
+      try:
+        raw = conn.recv(4096)
+      except OSError:
+        raw = b''
+
+      if not raw:
+        conn.close()
+        continue
+
+      conn.setblocking(True)            # Replies are sent with sendall
+      cmd_q.put((conn, raw))
+
+def command_worker():
 
   while True:
-    conn, _ = server.accept()
-    threading.Thread(target=handle_commands, args=(conn,), daemon=True).start()
 
-def handle_commands(conn):
+    conn, raw = cmd_q.get()
 
-  global rate
+    try:
+      handle_commands(conn, raw)
+    except Exception as e:              # A bad command must not stop the worker
+      print("Command failed: ", raw, e)
+      conn.close()
 
-  raw = conn.recv(4096)
-  if not raw:
-    conn.close()
-    return
+def handle_commands(conn, raw):
 
-  command = raw.decode('utf-8', errors='ignore').split()
+  command = list(map(int, raw.decode('utf-8', errors='ignore').split()))
 
-  block, channel, addr, bit = map(int, command)
+  block, channel, addr, bit = command[:4]
 
-  if block in (0, 1, 2):          # Instruction is to write a register
-    write_max(block, channel, addr, bit)
+  if block in (0, 1, 2):          # Instruction is to write registers
+    changes = [tuple(command[i:i + 4]) for i in range(0, len(command) - 3, 4)]
+    write_max_batch(changes)
     global_telemetry.log()
     conn.sendall(b"AFE Controls Updated\n")
 
@@ -358,38 +405,74 @@ def handle_commands(conn):
     conn.sendall(b"Telemetry Logged\n")
 
   elif block == 5:
-    rate = channel
-    rateStr = str(rate)
+    state.rate = channel
+    rate_changed.set()
+    rateStr = str(state.rate)
     response = f"Telemetry Log Period: {rateStr}s\n"
     conn.sendall(response.encode('ascii'))
 
   conn.close()
 
+def gpsd_lines(sock):
+
+  # Lines are split out of one preallocated buffer and screened as bytes;
+  # only sentences the service keeps are decoded. A corrupted byte on the
+  # serial line is dropped instead of raising UnicodeDecodeError and ending
+  # the monitor thread
+  buf = bytearray(65536)
+  view = memoryview(buf)
+  hi = 0
+
+  while True:
+    n = sock.recv_into(view[hi:])
+    if n == 0:                           # gpsd closed the connection
+      return
+    hi += n
+
+    lo = 0
+    nl = buf.find(b'\n', lo, hi)
+    while nl >= 0:
+      if buf.startswith(b'$PMITSR', lo, nl):   # command replies pace writes
+        cmd_ack.set()
+      elif buf.startswith(KEPT_PREFIXES, lo, nl):
+        end = nl - 1 if buf[nl - 1] == 0x0D else nl   # drop the '\r'
+        yield str(view[lo:end], 'ascii', 'ignore')
+      lo = nl + 1
+      nl = buf.find(b'\n', lo, hi)
+
+    if lo:                               # Keep the partial line, once per recv
+      view[:hi - lo] = view[lo:hi]
+      hi -= lo
+    elif hi == len(buf):                 # No newline in a full buffer, drop it
+      hi = 0
+
 def gpsd_monitor():
 
-  global gps_in_progress
-  global telem_in_progress
-  global regs_in_progress
+  # gpsd's JSON banner and WATCH replies never pass gpsd_lines' screen
+  for line in gpsd_lines(state.gpsd):
 
-  msg = gpsd.makefile('r', encoding='ascii', newline='\n')
-  _ = msg.readline()
+    kind = LINE_KINDS.get(line[1:5], 'gps')   # $GNRMC, $GPGSV, ... from the ublox
+    telem_q.put((kind, line))
 
-  for line in msg:     
-          
-    line = line.strip()
-          
-    if line.startswith('$PGPS'):
-      gps_in_progress = True
-      if global_telemetry.gps is not None:
-        global_telemetry.gps.clear()
+def telemetry_consumer():
+
+  # Sole writer of global_telemetry. New groups go into fresh lists so a
+  # log() still reading the previous group is never modified underneath
+  while True:
 
-    elif line.startswith('$PGPN'):
-      gps_in_progress = False
+    kind, line = telem_q.get()
 
-    elif line.startswith('$PTEL'):
-      global_telemetry.telem.clear()
+    if kind == 'gps_start':
+      global_telemetry.gps_ready.clear()
+      global_telemetry.gps = []
 
-    elif line.startswith('$G'):
+    elif kind == 'gps_end':
+      global_telemetry.gps_ready.set()
+
+    elif kind == 'telem_start':
+      global_telemetry.telem = []
+
+    elif kind == 'gps':
       global_telemetry.gps.append(line)
 
       if line.startswith('$GNRMC'):
@@ -397,125 +480,109 @@ def gpsd_monitor():
         if not error:
           global_telemetry.RTCtime = RTCtime
 
-    elif line.startswith('$PMIT') and '$PMITSR' not in line:
+    elif kind == 'telem':
       global_telemetry.telem.append(line)
       if line.startswith('$PMITG'):
-        telem_in_progress = False
-
-    elif line.startswith('$PMAX'):
-      split = line.split(',')
-      for row in range(1,8):
-        reg_row = []
-        for col in range(10):
-          reg_row.append(int(split[row][col]))
-        global_telemetry.registers.append(reg_row)
-      regs_in_progress = False
-
-    else:
+        global_telemetry.telem_ready.set()
+
+    elif kind == 'regs':
+      fields = [field[:10] for field in line.split(',')[1:8]]
+      block = ''.join(fields).encode('ascii')
+      if len(block) == 70 and block.isdigit():     # 7 registers x 10 bits
+        global_telemetry.registers[:] = block.translate(DIGIT_VALUES)
+        global_telemetry.regs_filled = 7
+      global_telemetry.regs_ready.set()
+
+def csv_writer():
+
+  while True:
+
+    full_path, rows = csv_q.get()
+
+    # Whole file is rendered in memory, written once, then renamed into
+    # place so a reader never sees a partial CSV
+    csv_buf = io.StringIO(newline="")
+    csv.writer(csv_buf).writerows(rows)
+    payload = csv_buf.getvalue().encode("utf-8")
+
+    tmp_path = full_path + ".tmp"
+    try:
+      with open(tmp_path, "wb") as telem_csv:
+        telem_csv.write(payload)
+      os.replace(tmp_path, full_path)
+    except OSError as e:
+      print("CSV write failed: ", full_path, e)
       continue
 
+    print("Telemetry logged at: ", os.path.basename(full_path))
+
 def nmea_to_epoch(nmea):
 
   error = False
+  epoch_time = None
 
   nmea_str = str(nmea)
 
   aa = nmea_str.split(",")
 
   try:
+    date = aa[9]
+    midnight = day_epochs.get(date)      # Date only changes once a day
+    if midnight is None:
+      DD = int(date[0:2])
+      MM = int(date[2:4])
+      YY = int(date[4:6]) + 2000
+      # timegm doesn't range check and RMC isn't checksum validated
+      if len(date) != 6 or not (1 <= MM <= 12) or \
+         not (1 <= DD <= calendar.monthrange(YY, MM)[1]):
+        raise ValueError(date)
+      midnight = calendar.timegm((YY, MM, DD, 0, 0, 0, 0, 0, 0))
+      day_epochs.clear()
+      day_epochs[date] = midnight
+
     hh = int(aa[1][0:2])
     mm = int(aa[1][2:4])
     ss = int(aa[1][4:6])
-    DD = int(aa[9][0:2])
-    MM = int(aa[9][2:4])
-    YY = int(aa[9][4:6]) + 2000
+    if not (0 <= hh < 24 and 0 <= mm < 60 and 0 <= ss < 61):
+      raise ValueError(aa[1])
 
-    dt = datetime(YY, MM, DD, hh, mm, ss, tzinfo=timezone.utc)
-    epoch_time = int(dt.timestamp())
+    epoch_time = midnight + hh * 3600 + mm * 60 + ss
     
   except:
     error = True
   
   return error, epoch_time
 
-def reduce(iterable, initializer=None):
-    it = iter(iterable)
-    if initializer is None:
-        value = next(it)
-    else:
-        value = initializer
-    for element in it:
-        value = value ^ element
-    return value
-
-def eval_packet(packet,gen_cksm_f=False,debug_f=False):
-     err_code = 0
-     ascii_checksum = 0
-     calculated_checksum = 0
-
-     dollar_cnt = packet.count("$")
-     star_cnt = packet.count("*")
-
-     if (packet[0] == '$'):
-       if (dollar_cnt != star_cnt):               # lost data
-         err_code = -1
-     else:                                       # pre-checked, should not happen
-       print("data does not begin with '$'", dollar_cnt, star_cnt)
-       err_code = -2
-     # end else error
-
-     if (err_code == 0):
-       packet = packet.strip("$\n")
-
-       nmeadata, ascii_checksum = packet.split("*",1)
-
-       checksum = None
-       if (not gen_cksm_f):              # checksum present, don't generate
-         try:
-           checksum = int(ascii_checksum,16)
-         except Exception as eobj:       # encountered noise instead of checksum
-           err_code = -3
-         # end except
-       else:
-         pass   # no checksum to extract
-       # else no checksum
-     # endif not error
-
-     if (err_code == 0):
-       calculated_checksum = reduce((ord(s) for s in nmeadata), 0)
-       if (checksum == calculated_checksum):
-         pass
-       else:
-         if (not gen_cksm_f):   # compare generated vs read
-           err_code = -4
-         else:
-           checksum = calculated_checksum
-         # end else use manufactured checksum
-       # end else bad checksum
-     # endif parse passes checks
-     return err_code, ascii_checksum, calculated_checksum
+def format_timestamp(epoch_time):
 
-def add_cksum(pkt_in):
+  return time.strftime("%Y-%m-%d_%H:%M:%S", time.gmtime(epoch_time))
+
+def eval_fast(pkt):
+
+  # Check '$', find '*', then XOR everything between them
+  if pkt[:1] != b'$':
+    return -2, 0
 
-  packet_out = ""
+  star = pkt.find(b'*', 1)
+  if star < 0 or pkt.find(b'$', 1, star) >= 0:   # lost data
+    return -1, 0
 
-  err_code, dck, cck = eval_packet(pkt_in,gen_cksm_f=True,debug_f=False)
-  if (err_code != 0):
-    err_f = True
-  # endif
+  return 0, reduce(xor, pkt[1:star], 0)  # bytes iterate as ints
 
-  ck_hex = hex(cck)             # to string
-  ck_split = ck_hex.split('x')  # split at hex identifier
-  ck_str = ck_split[1].upper()  # upper case
-  if ( len(ck_str) == 1):       # if single digit
-    ck_str = "0" + ck_str       # then prefix with '0', ex: "0A"
-  # endif single digit
+@lru_cache(maxsize=64)                 # Command strings repeat every log period
+def add_cksum(pkt_in):
+
+  err_code, cck = eval_fast(pkt_in.encode('ascii'))   # no checksum to parse yet
 
-  packet_out = pkt_in + ck_str
+  packet_out = pkt_in + f"{cck:02X}"   # two digit upper case hex, ex: "0A"
 
   return packet_out
 
-def write_max(block, channel, addr, bit):
+TELEM_CMD = add_cksum("$TELEM?*")
+MAX_CMD = add_cksum("$MAX?*")
+STATE_QUERY = TELEM_CMD + "\r\n" + MAX_CMD
+
+def max_sentence(block, channel, addr, bit):
 
   msg_draft = "$PMIT"
 
@@ -531,22 +598,39 @@ def write_max(block, channel, addr, bit):
     msg_draft += str(channel)
 
   else:
-    return 0
+    return None
 
   msg_draft += "," + str(addr) + "," + str(bit) + "*"
-  msg = add_cksum(msg_draft)
-  send_nmea_command(msg)
+  return add_cksum(msg_draft)
+
+def write_max_batch(changes):
+
+  # The firmware takes one line per loop pass, so each write waits for its
+  # $PMITSR reply before the next goes out. Only one sentence, then the
+  # STATE_QUERY from log(), is ever queued in the RP2040's 64 byte buffer
+  for change in changes:
+    msg = max_sentence(*change)
+    if msg is None:
+      continue
+
+    cmd_ack.clear()
+    send_nmea_command(msg)
+    if not cmd_ack.wait(CMD_ACK_TIMEOUT):
+      print("No reply to register write: ", msg)
 
   return
 
 def init_all():
 
-  global gpsd
-
-  gpsd = socket.create_connection(("127.0.0.1", 2947))
-  gpsd.sendall(b'?WATCH={"enable":true, "raw":1};\n')
+  # Receive buffer is sized before connect so TCP can advertise the window
+  state.gpsd = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  state.gpsd.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, GPSD_RCVBUF)
+  state.gpsd.connect(("127.0.0.1", 2947))
+  state.gpsd.sendall(b'?WATCH={"enable":true, "raw":1};\n')
 
   threading.Thread(target=start_command_server, daemon=True).start()
+  threading.Thread(target=telemetry_consumer, daemon=True).start()
+  threading.Thread(target=csv_writer, daemon=True).start()
   monitor = threading.Thread(target=gpsd_monitor, daemon=False)
   monitor.start()
 
@@ -554,20 +638,23 @@ def init_all():
 
 def main():
 
-  global rate
-
   global_telemetry.log()
 
-  start = time.monotonic()
+  deadline = time.monotonic() + state.rate
 
   while True:
-    if time.monotonic() - start >= rate:
-      start = time.monotonic()
-      global_telemetry.log()
+    if rate_changed.wait(max(0, deadline - time.monotonic())):
+      rate_changed.clear()               # New period starts from now
+      deadline = time.monotonic() + state.rate
+      continue
 
-if __name__ == '__main__':
+    global_telemetry.log()
 
-  new_run = True
+    deadline += state.rate               # Fixed cadence, no drift
+    if deadline < time.monotonic():      # Log overran a whole period
+      deadline = time.monotonic() + state.rate
+
+if __name__ == '__main__':
 
   init_all()
 